@@ -29,10 +29,17 @@
 
 import copy
 import operator
-from django.db import models
+import sys
+import time
+from contextlib import contextmanager
+from django.db import models, connections, transaction, DatabaseError
 from django.core.exceptions import FieldError, ImproperlyConfigured,\
         ValidationError
 from django.core.paginator import Paginator, InvalidPage
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
 from django.core import serializers 
 from django.utils.encoding import smart_str
 from django.http import Http404
@@ -42,6 +49,9 @@ import json
 
 django_json = serializers.get_serializer('json')()
 
+class QueryBudgetExceeded(Exception):
+    pass
+
 class JqGrid(object):
     queryset = None
     model = None
@@ -58,6 +68,14 @@ class JqGrid(object):
     form = None
     custom_widgets = {}
 
+    # query budget: max_rows caps the page size, statement_timeout (in
+    # milliseconds) bounds each of the count and page queries and
+    # max_query_cost rejects plans whose EXPLAIN cost estimate is above it.
+    max_rows = None
+    statement_timeout = None
+    max_query_cost = None
+    sqlite_progress_opcodes = 1000
+
     def get_queryset(self):
         request = self.request
         if hasattr(self, 'queryset') and self.queryset is not None:
@@ -84,8 +102,14 @@ class JqGrid(object):
         items = self.get_queryset()
         items = self.filter_items(items)
         items = self.sort_items(items)
+        self.check_query_cost(items)
+        using = items.db
+        with self.statement_timeout_guard(using):
+            paginator, page, items = self.paginate_items(items)
+        with self.statement_timeout_guard(using):
+            # evaluate the page here so the page query is bounded as well
+            items = list(items)
         items = self.check_for_foreign_keys(items)
-        paginator, page, items = self.paginate_items(items)
         return (paginator, page, items)
 
     def get_filters(self):
@@ -196,6 +220,8 @@ class JqGrid(object):
             paginate_by = int(rows)
         except ValueError:
             paginate_by = 10
+        if self.max_rows and not 0 < paginate_by <= self.max_rows:
+            paginate_by = self.max_rows
         return paginate_by
 
     def paginate_items(self, items):
@@ -215,9 +241,129 @@ class JqGrid(object):
             page = paginator.page(1)
         return (paginator, page, page.object_list)
 
+    def get_query_cost(self, items):
+        '''Return the planner cost estimate for items, or None if the
+        database backend can't provide one'''
+        connection = connections[items.db]
+        if connection.vendor != 'postgresql':
+            return None
+        try:
+            sql, params = items.query.get_compiler(items.db).as_sql()
+        except EmptyResultSet:
+            return 0
+        cursor = connection.cursor()
+        try:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return plan[0]['Plan']['Total Cost']
+
+    def check_query_cost(self, items):
+        if self.max_query_cost is None:
+            return
+        cost = self.get_query_cost(items)
+        if cost is not None and cost > self.max_query_cost:
+            raise QueryBudgetExceeded('Query is too expensive (cost %s, '
+                    'limit %s), please refine your search'
+                    % (cost, self.max_query_cost))
+
+    def is_statement_timeout(self, connection, error):
+        if connection.vendor == 'postgresql':
+            cause = getattr(error, '__cause__', None)
+            pgcode = getattr(error, 'pgcode', None) or \
+                    getattr(cause, 'pgcode', None)
+            # django < 1.6 re-raises without pgcode, only the message is left
+            message = 'canceling statement due to statement timeout'
+            return pgcode == '57014' or message in str(error)
+        elif connection.vendor == 'sqlite':
+            return 'interrupted' in str(error)
+        return False
+
+    def get_driver(self, connection):
+        '''Return the DB-API module used by connection'''
+        driver = getattr(connection, 'Database', None)
+        if driver is None:
+            driver = sys.modules[connection.__class__.__module__].Database
+        return driver
+
+    @contextmanager
+    def postgresql_statement_timeout(self, connection, using):
+        cursor = connection.cursor()
+        cursor.execute('SHOW statement_timeout')
+        previous = cursor.fetchone()[0]
+        timeout = int(self.statement_timeout)
+        atomic = getattr(transaction, 'atomic', None)
+        if atomic is not None:
+            # django >= 1.6 runs in autocommit mode, SET LOCAL needs a
+            # transaction (or savepoint) around it to have any effect
+            with atomic(using=using):
+                cursor.execute('SET LOCAL statement_timeout = %s', [timeout])
+                yield
+                # SET LOCAL outlives a savepoint, put the old value back
+                cursor.execute('SET LOCAL statement_timeout = %s', [previous])
+        else:
+            sid = transaction.savepoint(using=using)
+            cursor.execute('SET LOCAL statement_timeout = %s', [timeout])
+            try:
+                yield
+            except Exception:
+                # leave the transaction usable for the rest of the request
+                transaction.savepoint_rollback(sid, using=using)
+                raise
+            cursor.execute('SET LOCAL statement_timeout = %s', [previous])
+            transaction.savepoint_commit(sid, using=using)
+
+    @contextmanager
+    def sqlite_statement_timeout(self, connection, using):
+        deadline = time.time() + self.statement_timeout / 1000.0
+        connection.cursor()
+        connection.connection.set_progress_handler(
+            lambda: time.time() > deadline, self.sqlite_progress_opcodes)
+        try:
+            yield
+        finally:
+            connection.connection.set_progress_handler(None, 0)
+
+    @contextmanager
+    def statement_timeout_guard(self, using):
+        '''Abort a statement run inside the block on the using database
+        if it takes longer than statement_timeout milliseconds'''
+        connection = connections[using]
+        if not self.statement_timeout or \
+                connection.vendor not in ('postgresql', 'sqlite'):
+            yield
+            return
+        if connection.vendor == 'postgresql':
+            guard = self.postgresql_statement_timeout(connection, using)
+        else:
+            guard = self.sqlite_statement_timeout(connection, using)
+        # older django versions don't wrap every driver error, interrupted
+        # fetches on sqlite for example
+        errors = (DatabaseError, self.get_driver(connection).DatabaseError)
+        try:
+            with guard:
+                yield
+        except errors as e:
+            if not self.is_statement_timeout(connection, e):
+                raise
+            raise QueryBudgetExceeded('Query took longer than %sms, please '
+                    'refine your search' % self.statement_timeout)
+
     def get_json(self, request):
         self.request = request
-        paginator, page, items = self.get_items()
+        try:
+            paginator, page, items = self.get_items()
+        except QueryBudgetExceeded as e:
+            return json.dumps({
+                'page': 1,
+                'total': 0,
+                'rows': [],
+                'records': 0,
+                'error': str(e)
+            })
         items = self.to_array(items)
         data = {
             'page': page.number,
@@ -1,11 +1,13 @@
 from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.forms import ModelForm
-from django.db import models
+from django.db import models, connections, DatabaseError
 from django.test import TestCase
 from django.test.simple import DjangoTestSuiteRunner
 import json
+import time
 import fudge
-from jqgrid import JqGrid
+import jqgrid
+from jqgrid import JqGrid, QueryBudgetExceeded
 
 #models for testing
 from django.contrib.auth.models import User 
@@ -22,6 +24,30 @@ class BookShelf(models.Model):
     def __unicode__(self):
         return self.location
 
+#local stand-in for the planner cost: sqlite has no cost estimates, so count
+#the full table scans in the query plan
+class ScanCountingGrid(JqGrid):
+    def get_query_cost(self, items):
+        sql, params = items.query.get_compiler(items.db).as_sql()
+        cursor = connections[items.db].cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return len([row for row in cursor.fetchall()
+                    if row[-1].startswith('SCAN')])
+
+SLOW_SQL = ('(WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n '
+            'WHERE x < 100000000) SELECT count(*) FROM n)')
+
+class FakeAtomic(object):
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        self.log.append(('atomic_enter',))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.log.append(('atomic_exit', exc_type))
+        return False
+
 #forms
 class LibraryUserForm(ModelForm):
     class Meta:
@@ -209,6 +235,164 @@ class JqGridTest(TestCase):
         config = json.loads(self.jqgrid.get_config(self.request))
         self.assertEquals(2,config['colModel'][2]['editoptions']['value'].__len__())
 
+    def test_get_paginate_by_should_not_exceed_max_rows(self):
+        self.jqgrid.max_rows = 50
+        self.request.GET = {'rows': '1000000'}
+        self.jqgrid.request = self.request
+        self.assertEquals(50, self.jqgrid.get_paginate_by())
+        self.request.GET = {'rows': '0'}
+        self.assertEquals(50, self.jqgrid.get_paginate_by())
+        self.request.GET = {'rows': '25'}
+        self.assertEquals(25, self.jqgrid.get_paginate_by())
+
+    def test_it_should_return_an_error_when_query_cost_is_too_high(self):
+        self.request.GET = {'_search': 'false', 'rows': '10', 'page': '1'}
+        grid = ScanCountingGrid()
+        grid.model = LibraryUser
+        grid.max_query_cost = 0
+        # only the EXPLAIN runs, neither the count nor the page query
+        response = json.loads(self.assertNumQueries(1, grid.get_json,
+                                                    self.request))
+        self.assertTrue('too expensive' in response['error'])
+        self.assertEquals([], response['rows'])
+
+    def test_it_should_return_rows_when_query_cost_is_within_budget(self):
+        self.request.GET = {'_search': 'false', 'rows': '10', 'page': '1'}
+        grid = ScanCountingGrid()
+        grid.model = LibraryUser
+        grid.max_query_cost = 1
+        response = json.loads(grid.get_json(self.request))
+        self.assertFalse('error' in response)
+        self.assertEquals(3, response['records'])
+
+    def test_statement_timeout_should_return_an_error_for_slow_queries(self):
+        self.request.GET = {'_search': 'false', 'rows': '10', 'page': '1'}
+        self.jqgrid.queryset = LibraryUser.objects.values('id').extra(
+                where=[SLOW_SQL + ' > 0'])
+        self.jqgrid.statement_timeout = 10
+        response = json.loads(self.jqgrid.get_json(self.request))
+        self.assertTrue('longer than 10ms' in response['error'])
+        self.assertEquals([], response['rows'])
+
+    def test_statement_timeout_should_clear_the_progress_handler(self):
+        from django.db import connection
+        self.jqgrid.statement_timeout = 1
+        with self.jqgrid.statement_timeout_guard('default'):
+            pass
+        time.sleep(0.01)
+        cursor = connection.cursor()
+        cursor.execute('SELECT ' + SLOW_SQL.replace('100000000', '100000'))
+        self.assertEquals(100000, cursor.fetchone()[0])
+
+    def test_statement_timeout_should_reraise_other_database_errors(self):
+        from django.db import connection
+        self.jqgrid.statement_timeout = 1
+        try:
+            with self.jqgrid.statement_timeout_guard('default'):
+                time.sleep(0.01)
+                connection.cursor().execute('SELECT * FROM no_such_table')
+            self.fail('DatabaseError should be raised at this point')
+        except QueryBudgetExceeded:
+            self.fail('DatabaseError should not be reported as a timeout')
+        except DatabaseError:
+            pass
+
+    def test_statement_timeout_should_not_affect_fast_queries(self):
+        self.request.GET = {'_search': 'false', 'rows': '10', 'page': '1'}
+        self.jqgrid.statement_timeout = 10000
+        response = json.loads(self.jqgrid.get_json(self.request))
+        self.assertEquals(3, response['records'])
+
+    def test_postgresql_timeout_should_use_a_savepoint_without_atomic(self):
+        log = []
+        cursor = self.setup_fake_postgresql(log)
+        self.jqgrid.statement_timeout = 10
+        with self.jqgrid.statement_timeout_guard('default'):
+            cursor.execute('SELECT 1')
+        self.assertEquals([
+            ('execute', 'SHOW statement_timeout', None),
+            ('savepoint',),
+            ('execute', 'SET LOCAL statement_timeout = %s', [10]),
+            ('execute', 'SELECT 1', None),
+            ('execute', 'SET LOCAL statement_timeout = %s', ['30s']),
+            ('savepoint_commit', 'sid'),
+        ], log)
+
+    def test_postgresql_timeout_should_rollback_the_savepoint(self):
+        log = []
+        cursor = self.setup_fake_postgresql(log)
+        self.jqgrid.statement_timeout = 10
+        try:
+            with self.jqgrid.statement_timeout_guard('default'):
+                raise DatabaseError(
+                        'canceling statement due to statement timeout')
+            self.fail('QueryBudgetExceeded should be raised at this point')
+        except QueryBudgetExceeded:
+            pass
+        self.assertEquals([
+            ('execute', 'SHOW statement_timeout', None),
+            ('savepoint',),
+            ('execute', 'SET LOCAL statement_timeout = %s', [10]),
+            ('savepoint_rollback', 'sid'),
+        ], log)
+
+    def test_postgresql_timeout_should_run_inside_atomic(self):
+        log = []
+        cursor = self.setup_fake_postgresql(log, atomic=True)
+        self.jqgrid.statement_timeout = 10
+        with self.jqgrid.statement_timeout_guard('default'):
+            cursor.execute('SELECT 1')
+        self.assertEquals([
+            ('execute', 'SHOW statement_timeout', None),
+            ('atomic_enter',),
+            ('execute', 'SET LOCAL statement_timeout = %s', [10]),
+            ('execute', 'SELECT 1', None),
+            ('execute', 'SET LOCAL statement_timeout = %s', ['30s']),
+            ('atomic_exit', None),
+        ], log)
+
+    def test_postgresql_timeout_inside_atomic_should_rollback(self):
+        log = []
+        cursor = self.setup_fake_postgresql(log, atomic=True)
+        self.jqgrid.statement_timeout = 10
+        try:
+            with self.jqgrid.statement_timeout_guard('default'):
+                raise DatabaseError(
+                        'canceling statement due to statement timeout')
+            self.fail('QueryBudgetExceeded should be raised at this point')
+        except QueryBudgetExceeded:
+            pass
+        self.assertEquals([
+            ('execute', 'SHOW statement_timeout', None),
+            ('atomic_enter',),
+            ('execute', 'SET LOCAL statement_timeout = %s', [10]),
+            ('atomic_exit', DatabaseError),
+        ], log)
+
+    def setup_fake_postgresql(self, log, atomic=False):
+        cursor = fudge.Fake('cursor')
+        cursor.provides('execute').calls(
+                lambda sql, params=None: log.append(('execute', sql, params)))
+        cursor.provides('fetchone').returns(('30s',))
+        driver = fudge.Fake('Database').has_attr(DatabaseError=DatabaseError)
+        connection = fudge.Fake('connection').has_attr(vendor='postgresql',
+                                                        Database=driver)
+        connection.provides('cursor').returns(cursor)
+        transaction = fudge.Fake('transaction')
+        if atomic:
+            transaction.provides('atomic').calls(
+                    lambda using: FakeAtomic(log))
+        else:
+            transaction.provides('savepoint').calls(
+                    lambda using: log.append(('savepoint',)) or 'sid')
+            transaction.provides('savepoint_rollback').calls(
+                    lambda sid, using: log.append(('savepoint_rollback', sid)))
+            transaction.provides('savepoint_commit').calls(
+                    lambda sid, using: log.append(('savepoint_commit', sid)))
+        for name, fake in (('connections', {'default': connection}),
+                           ('transaction', transaction)):
+            self.addCleanup(fudge.patch_object(jqgrid, name, fake).restore)
+        return cursor
 
     def setup_default_get(self):
         self.request.method = 'GET'